@@ -12,7 +12,9 @@ Support for serialization of numpy data types with msgpack.
 import sys
 import functools
 import pickle
+import struct
 import warnings
+import zlib
 
 import msgpack
 from msgpack import Packer as _Packer, Unpacker as _Unpacker, \
@@ -291,6 +293,210 @@ loads = unpackb
 dump = pack
 dumps = packb
 
+# Frame header layout (big-endian): magic, flags, payload length, CRC32 of
+# the payload (0 unless the CRC flag is set), CRC32 of the preceding header
+# fields. The header CRC lets a corrupted length be rejected before the
+# payload is read:
+FRAME_MAGIC = b'\x93NPF'
+_FRAME_CRC = 0x01
+_frame_header = struct.Struct('>4sBIII')
+
+def _crc32(data):
+    return zlib.crc32(data) & 0xffffffff
+
+def _frame_prefix(payload, crc):
+    flags = _FRAME_CRC if crc else 0
+    head = struct.pack('>4sBII', FRAME_MAGIC, flags, len(payload),
+                       _crc32(payload) if crc else 0)
+    return head + struct.pack('>I', _crc32(head))
+
+def pack_frame(o, stream, crc=True, **kwargs):
+    """
+    Pack an object and write it to a stream as a length-prefixed frame.
+    """
+
+    payload = Packer(**kwargs).pack(o)
+    stream.write(_frame_prefix(payload, crc))
+    stream.write(payload)
+
+def packb_frame(o, crc=True, **kwargs):
+    """
+    Pack an object and return it as a length-prefixed frame.
+    """
+
+    payload = Packer(**kwargs).pack(o)
+    return _frame_prefix(payload, crc) + payload
+
+class FrameUnpacker(object):
+    """
+    Unpack length-prefixed frames written by `pack_frame` from a stream.
+
+    The header of each frame is read first, and its payload is then read
+    into a single buffer allocated from the length prefix. Frames whose
+    header fails its CRC32 check or whose length exceeds `max_frame_size`
+    are rejected before their payload is read; frames that are truncated by
+    the end of the stream, fail their payload CRC32 check or cannot be
+    decoded are rejected afterwards. In either case the reader scans forward
+    for the next frame marker; the number of times this was needed between
+    valid frames is recorded in the `skipped` attribute. Frames written with
+    `crc=False` are only rejected if their payload cannot be decoded.
+
+    `unpack` raises `msgpack.OutOfData` when no complete frame is available.
+    A partially received frame is kept, so `unpack` may be retried once more
+    data arrives on a non-blocking stream or after the stream raises an
+    exception such as a timeout. Remaining keyword arguments are passed to
+    `unpackb`.
+    """
+
+    def __init__(self, file_like, max_frame_size=100 * 1024 * 1024,
+                 **kwargs):
+        self.file_like = file_like
+        self.max_frame_size = max_frame_size
+        self.skipped = 0
+        self._kwargs = kwargs
+
+        # Bytes pushed back while scanning for the next frame marker:
+        self._pending = bytearray()
+        self._scanning = False
+        self._resyncing = False
+
+        # Partially read frame; the payload buffer is allocated once its
+        # header has been read and checked:
+        self._header = bytearray(_frame_header.size)
+        self._payload = None
+        self._n = 0
+
+    def _fill(self):
+        """
+        Fill the current frame buffer from pushed-back bytes and then the
+        stream. Return True if the buffer is full, None if no data is
+        currently available and False at the end of the stream.
+        """
+
+        buf = self._header if self._payload is None else self._payload
+        view = memoryview(buf)
+        m = min(len(self._pending), len(buf) - self._n)
+        if m:
+            view[self._n:self._n + m] = self._pending[:m]
+            del self._pending[:m]
+            self._n += m
+        readinto = getattr(self.file_like, 'readinto', None)
+        while self._n < len(buf):
+            if readinto is not None:
+                m = readinto(view[self._n:])
+            else:
+                data = self.file_like.read(len(buf) - self._n)
+                m = None if data is None else len(data)
+                if m:
+                    view[self._n:self._n + m] = data
+            if m is None:
+                return None
+            if not m:
+                return False
+            self._n += m
+        return True
+
+    def _reject(self):
+        """
+        Push back the bytes of a bad frame after its marker and start scanning
+        for the next frame marker.
+        """
+
+        if self._payload is None:
+            consumed = self._header[1:self._n]
+        else:
+            consumed = self._header[1:] + self._payload[:self._n]
+        self._pending[:0] = consumed
+        self._payload = None
+        self._n = 0
+        self._scanning = True
+        if not self._resyncing:
+            self._resyncing = True
+            self.skipped += 1
+
+    def _scan(self):
+        """
+        Discard bytes until the next frame marker; return False if no marker
+        is available yet.
+        """
+
+        read = getattr(self.file_like, 'read1', None)
+        while True:
+            i = self._pending.find(FRAME_MAGIC)
+            if i >= 0:
+                del self._pending[:i]
+                self._scanning = False
+                return True
+
+            # Keep a possible partial marker at the end of the buffer:
+            del self._pending[:max(0, len(self._pending) - len(FRAME_MAGIC) + 1)]
+
+            # Only request as much as is available so that a live stream
+            # doesn't block on data that hasn't been sent yet:
+            if read is not None:
+                data = read(_frame_header.size)
+            else:
+                data = self.file_like.read(1)
+            if not data:
+                return False
+            self._pending.extend(data)
+
+    def unpack(self):
+        """
+        Unpack and return the next valid frame; raise `msgpack.OutOfData` if
+        no complete frame is available.
+        """
+
+        while True:
+            if self._scanning and not self._scan():
+                raise msgpack.OutOfData
+            filled = self._fill()
+            if filled is False and (self._n or self._payload is not None):
+                # The stream ended partway through a frame:
+                self._reject()
+                continue
+            if not filled:
+                raise msgpack.OutOfData
+
+            if self._payload is None:
+                magic, flags, length, crc, header_crc = \
+                    _frame_header.unpack_from(self._header)
+                if magic != FRAME_MAGIC or flags & ~_FRAME_CRC or \
+                   header_crc != _crc32(self._header[:-4]) or \
+                   length > self.max_frame_size:
+                    self._reject()
+                    continue
+                self._payload = bytearray(length)
+                self._n = 0
+                continue
+
+            magic, flags, length, crc, header_crc = \
+                _frame_header.unpack_from(self._header)
+            if flags & _FRAME_CRC and crc != _crc32(self._payload):
+                self._reject()
+                continue
+            try:
+                obj = unpackb(self._payload, **self._kwargs)
+            except Exception:
+                # Corrupted payloads can fail anywhere in msgpack, numpy or
+                # pickle decoding:
+                self._reject()
+                continue
+            self._payload = None
+            self._n = 0
+            self._resyncing = False
+            return obj
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        try:
+            return self.unpack()
+        except msgpack.OutOfData:
+            raise StopIteration
+    next = __next__ # Python 2
+
 def patch():
     """
     Monkey patch msgpack module to enable support for serializing numpy types.
@@ -1,13 +1,16 @@
 #!/usr/bin/env python
 
+import socket
 import sys
+from io import BytesIO
 from unittest import main, TestCase
 
 import msgpack
 import numpy as np
 from numpy.testing import assert_equal, assert_array_equal
 
-from msgpack_numpy import patch
+from msgpack_numpy import patch, packb, pack_frame, packb_frame, \
+    FrameUnpacker, FRAME_MAGIC
 
 try:
     range = xrange # Python 2
@@ -288,5 +291,167 @@ class test_numpy_msgpack(TestCase):
         assert_array_equal(x, x_rec)
         self.assertEqual(x.dtype, x_rec.dtype)
 
+class TrickleStream(object):
+    """
+    Stream without readinto that returns at most a few bytes per read.
+    """
+
+    def __init__(self, data, size=3):
+        self.buf = BytesIO(data)
+        self.size = size
+
+    def read(self, n=-1):
+        return self.buf.read(min(n, self.size) if n >= 0 else self.size)
+
+class FlakyStream(object):
+    """
+    Stream that raises an error once after a given number of bytes.
+    """
+
+    def __init__(self, data, fail_at):
+        self.buf = BytesIO(data)
+        self.fail_at = fail_at
+
+    def readinto(self, b):
+        pos = self.buf.tell()
+        if self.fail_at is not None and pos + len(b) > self.fail_at:
+            n = self.buf.readinto(memoryview(b)[:self.fail_at - pos])
+            if n:
+                return n
+            self.fail_at = None
+            raise IOError('read failed')
+        return self.buf.readinto(b)
+
+class test_frame(TestCase):
+    def test_roundtrip(self):
+        x = np.random.rand(5, 3)
+        buf = BytesIO()
+        pack_frame(x, buf)
+        pack_frame({b'foo': np.int32(1)}, buf, crc=False)
+        buf.seek(0)
+        res = list(FrameUnpacker(buf))
+        assert_array_equal(res[0], x)
+        assert_equal(res[1], {b'foo': np.int32(1)})
+
+    def test_corrupt_frame(self):
+        x = np.arange(10)
+        bad = bytearray(packb_frame(x))
+        bad[-1] ^= 0xff
+        buf = BytesIO(packb_frame(1) + bytes(bad) + packb_frame(x))
+        unpacker = FrameUnpacker(buf)
+        res = list(unpacker)
+        assert_equal(res[0], 1)
+        assert_array_equal(res[1], x)
+        assert_equal(len(res), 2)
+        assert_equal(unpacker.skipped, 1)
+
+    def test_truncated_frame(self):
+        x = np.arange(10)
+        buf = BytesIO(b'junk' + packb_frame(x)[:-5] + packb_frame(x) +
+                      packb_frame(x)[:-5])
+        res = list(FrameUnpacker(buf))
+        assert_equal(len(res), 1)
+        assert_array_equal(res[0], x)
+
+    def test_max_frame_size(self):
+        buf = BytesIO(packb_frame(np.zeros(100)) + packb_frame(1))
+        unpacker = FrameUnpacker(buf, max_frame_size=100)
+        assert_equal(list(unpacker), [1])
+        assert_equal(unpacker.skipped, 1)
+
+    def test_corrupt_frame_no_crc(self):
+        x = np.arange(10)
+        bad = bytearray(packb_frame(x, crc=False))
+        bad[-len(packb(x))] = 0xc1 # never used in msgpack
+        buf = BytesIO(bytes(bad) + packb_frame(x, crc=False))
+        unpacker = FrameUnpacker(buf)
+        res = list(unpacker)
+        assert_equal(len(res), 1)
+        assert_array_equal(res[0], x)
+        assert_equal(unpacker.skipped, 1)
+
+    def test_corrupt_length(self):
+        bad = bytearray(packb_frame(1))
+        bad[8] ^= 0x01
+        buf = BytesIO(bytes(bad) + packb_frame(2))
+        unpacker = FrameUnpacker(buf)
+        assert_equal(list(unpacker), [2])
+        assert_equal(unpacker.skipped, 1)
+
+    def test_no_readinto(self):
+        x = np.arange(10)
+        bad = bytearray(packb_frame(x))
+        bad[-1] ^= 0xff
+        stream = TrickleStream(packb_frame(1) + bytes(bad) + packb_frame(x))
+        res = list(FrameUnpacker(stream))
+        assert_equal(res[0], 1)
+        assert_array_equal(res[1], x)
+        assert_equal(len(res), 2)
+
+    def test_socket(self):
+        a, b = socket.socketpair()
+        try:
+            b.settimeout(5)
+            f = b.makefile('rb')
+            unpacker = FrameUnpacker(f)
+            a.sendall(packb_frame(1))
+            assert_equal(unpacker.unpack(), 1)
+            a.sendall(b'junk' + packb_frame(np.arange(3)))
+            assert_array_equal(unpacker.unpack(), np.arange(3))
+            a.close()
+            assert_equal(list(unpacker), [])
+            f.close()
+        finally:
+            a.close()
+            b.close()
+
+    def test_corrupt_object_array_no_crc(self):
+        x = np.array([1, 'a', None], dtype=object)
+        bad = bytearray(packb_frame(x, crc=False))
+        i = bad.find(x.dumps())
+        bad[i] ^= 0xff
+        buf = BytesIO(bytes(bad) + packb_frame(1, crc=False))
+        unpacker = FrameUnpacker(buf)
+        assert_equal(list(unpacker), [1])
+        assert_equal(unpacker.skipped, 1)
+
+    def test_skipped_marker_in_payload(self):
+        x = np.frombuffer(FRAME_MAGIC * 8, dtype=np.uint8)
+        bad = bytearray(packb_frame(x))
+        bad[-1] ^= 0xff
+        buf = BytesIO(bytes(bad) + packb_frame(1))
+        unpacker = FrameUnpacker(buf)
+        assert_equal(list(unpacker), [1])
+        assert_equal(unpacker.skipped, 1)
+
+    def test_retry_after_error(self):
+        x = np.arange(10)
+        data = packb_frame(1) + packb_frame(x)
+        unpacker = FrameUnpacker(FlakyStream(data, len(packb_frame(1)) + 20))
+        assert_equal(unpacker.unpack(), 1)
+        self.assertRaises(IOError, unpacker.unpack)
+        assert_array_equal(unpacker.unpack(), x)
+        assert_equal(unpacker.skipped, 0)
+
+    def test_socket_nonblocking(self):
+        a, b = socket.socketpair()
+        try:
+            b.setblocking(False)
+            f = b.makefile('rb')
+            unpacker = FrameUnpacker(f)
+            self.assertRaises(msgpack.OutOfData, unpacker.unpack)
+            frame = packb_frame(np.arange(10))
+            for part in (frame[:5], frame[5:30]):
+                a.sendall(part)
+                self.assertRaises(msgpack.OutOfData, unpacker.unpack)
+            a.sendall(frame[30:] + packb_frame(1))
+            assert_array_equal(unpacker.unpack(), np.arange(10))
+            assert_equal(unpacker.unpack(), 1)
+            assert_equal(unpacker.skipped, 0)
+            f.close()
+        finally:
+            a.close()
+            b.close()
+
 if __name__ == '__main__':
     main()